@@ -1,17 +1,24 @@
+import asyncio
 import base64
 import datetime
+import hashlib
+import heapq
+import hmac
 import json
 import os
 import random
+import socket
+import struct
 import time
 import requests
+import aiohttp
 import nacl.public
 import nacl.utils
 import nacl.bindings
 import subprocess
 import platform
-import concurrent.futures
-from typing import List, Dict, Any, Tuple, Optional
+from operator import attrgetter
+from typing import Awaitable, List, Dict, Any, NamedTuple, Tuple, Optional
 
 # --- Constants ---
 WARP_API_URL = "https://api.cloudflareclient.com/v0a4005/reg"
@@ -30,9 +37,13 @@ IPV6_PREFIXES = [
     "2606:4700:d0::", "2606:4700:d1::",
 ]
 
-CORE_INIT_PORT = 10800
+CORE_INIT_PORT = 10800 # Single local HTTP inbound shared by all candidates
+PROXY_ACCOUNT_PASSWORD = "x" # Inbound accounts only select the outbound, the password is not a secret
+PROXY_URL = f"http://127.0.0.1:{CORE_INIT_PORT}"
 CORE_DIR = "xray_core_temp_files"  # Directory for Xray temporary files
 XRAY_CONFIG_FILE = os.path.join(CORE_DIR, "config.json")
+# Xray logs are only written with WES_DEBUG=1, otherwise its output is discarded
+DEBUG = os.environ.get("WES_DEBUG") == "1"
 # Xray log file paths (for debugging)
 XRAY_LOG_STDOUT_FILE = os.path.join(CORE_DIR, "xray_stdout.log")
 XRAY_LOG_STDERR_FILE = os.path.join(CORE_DIR, "xray_stderr.log")
@@ -43,22 +54,43 @@ if platform.system() == "Windows":
 else:
     XRAY_EXECUTABLE_PATH = "./xray"
 
+XRAY_READY_TIMEOUT_SECONDS = 15
+
+# "handshake" checks that each endpoint answers a WireGuard handshake directly over UDP, no Xray needed;
+# "xray" tunnels an HTTP request through every endpoint via a local Xray process instead
+PROBE_MODE = os.environ.get("WES_PROBE_MODE", "handshake")
+
+# WireGuard (Noise_IKpsk2) protocol constants
+WG_CONSTRUCTION = b"Noise_IKpsk2_25519_ChaChaPoly_BLAKE2s"
+WG_IDENTIFIER = b"WireGuard v1 zx2c4 Jason@zx2c4.com"
+WG_LABEL_MAC1 = b"mac1----"
+WG_HANDSHAKE_RESPONSE_SIZE = 92
+
 TEST_URL = "http://www.gstatic.com/generate_204"
 TEST_TRIES = 3
 TEST_TIMEOUT_SECONDS = 2
-MAX_CONCURRENT_TESTS = 20 
+MAX_CONCURRENT_TESTS = 200 # Upper bound on probes in flight; each run uses one slot per candidate up to this
 NUM_CANDIDATES_PER_TYPE_TARGET = 60 # Increased number of candidates
 
-ScanResult = Tuple[str, float, float] # endpoint, avg_latency_ms, loss_rate_percent
+class ScanResult(NamedTuple):
+    endpoint: str
+    latency: float # Average latency in ms
+    loss: float # Loss rate in percent
+    is_ipv6: bool
+
+class ProxyTask(NamedTuple):
+    endpoint: str
+    account_user: str # Inbound account whose routing rule selects this endpoint's outbound
+    outbound_tag: str
+    proxy_auth: aiohttp.BasicAuth
 
 def generate_wireguard_keypair() -> Tuple[str, str]:
     """Generates a WireGuard key pair."""
     private_key_bytes = bytearray(os.urandom(32))
     private_key_bytes[0] &= 248
-    private_key_bytes[31] &= 127
-    private_key_bytes[31] |= 64
+    private_key_bytes[31] = (private_key_bytes[31] & 127) | 64
     public_key_bytes = nacl.bindings.crypto_scalarmult_base(bytes(private_key_bytes))
-    private_key_b64 = base64.b64encode(bytes(private_key_bytes)).decode('utf-8')
+    private_key_b64 = base64.b64encode(private_key_bytes).decode('utf-8') # b64encode takes the bytearray as-is
     public_key_b64 = base64.b64encode(public_key_bytes).decode('utf-8')
     return public_key_b64, private_key_b64
 
@@ -119,224 +151,372 @@ def get_warp_params_for_xray() -> Optional[Dict[str, Any]]:
     
     return extract_warp_parameters(config_data, client_private_key)
 
-def generate_candidate_endpoints(num_ipv4: int, num_ipv6: int, existing_endpoints: Optional[set[str]] = None) -> List[str]:
+def generate_candidate_endpoints(num_ipv4: int, num_ipv6: int) -> List[str]:
     """Generates unique candidate IP:Port endpoints."""
-    if existing_endpoints is None:
-        existing_endpoints = set()
-    
-    endpoints: List[str] = []
-    generated_ipv4_count = 0
-    generated_ipv6_count = 0
-    
-    max_attempts_factor = 5 # To prevent infinite loops
-    
-    # Generate IPv4
-    attempts_ipv4 = 0
-    while generated_ipv4_count < num_ipv4 and attempts_ipv4 < num_ipv4 * max_attempts_factor:
-        prefix = random.choice(IPV4_PREFIXES)
-        ip_part = random.randint(0, 255)
-        port = random.choice(PORTS)
-        endpoint = f"{prefix}{ip_part}:{port}"
-        if endpoint not in existing_endpoints:
-            existing_endpoints.add(endpoint)
-            endpoints.append(endpoint)
-            generated_ipv4_count +=1
-        attempts_ipv4 += 1
-    
-    # Generate IPv6
-    attempts_ipv6 = 0
-    # Temporary list for IPv6 to ensure correct count before extending main list
-    temp_ipv6_endpoints: List[str] = []
-    while generated_ipv6_count < num_ipv6 and attempts_ipv6 < num_ipv6 * max_attempts_factor:
-        prefix = random.choice(IPV6_PREFIXES)
-        hex_parts = [format(random.randint(0, 65535), 'x') for _ in range(4)]
-        ip_part = f"{prefix}{':'.join(hex_parts)}"
-        port = random.choice(PORTS)
-        endpoint = f"[{ip_part}]:{port}"
-        if endpoint not in existing_endpoints:
-            existing_endpoints.add(endpoint)
-            temp_ipv6_endpoints.append(endpoint)
-            generated_ipv6_count +=1
-        attempts_ipv6 += 1
-    
-    endpoints.extend(temp_ipv6_endpoints) # Add generated IPv6 endpoints to the main list
-
-    if attempts_ipv4 >= num_ipv4 * max_attempts_factor or attempts_ipv6 >= num_ipv6 * max_attempts_factor :
-        print("Warning: Reached max attempts for generating unique endpoints. Fewer may have been generated.")
-
+    # Generate IPv4: sample distinct indices of the prefix x host x port space and decode them,
+    # so duplicates are impossible and no retry loop or membership checks are needed
+    hosts_x_ports = 256 * len(PORTS)
+    ipv4_space_size = len(IPV4_PREFIXES) * hosts_x_ports
+    ipv4_endpoints: List[str] = []
+    for index in random.sample(range(ipv4_space_size), min(num_ipv4, ipv4_space_size)):
+        prefix_index, rest = divmod(index, hosts_x_ports)
+        ip_part, port_index = divmod(rest, len(PORTS))
+        ipv4_endpoints.append(f"{IPV4_PREFIXES[prefix_index]}{ip_part}:{PORTS[port_index]}")
+
+    # Generate IPv6: the 64-bit suffix space makes collisions negligible, so draw exactly num_ipv6 unchecked.
+    # All suffix bytes are hex-encoded in one C call, then sliced 16 hex digits per address
+    suffix_hex = os.urandom(8 * num_ipv6).hex()
+    ipv6_endpoints = [
+        f"[{prefix}{suffix_hex[j:j+4]}:{suffix_hex[j+4:j+8]}:{suffix_hex[j+8:j+12]}:{suffix_hex[j+12:j+16]}]:{port}"
+        for prefix, j, port in zip(
+            random.choices(IPV6_PREFIXES, k=num_ipv6),
+            range(0, len(suffix_hex), 16),
+            random.choices(PORTS, k=num_ipv6),
+        )
+    ]
+
+    if len(ipv4_endpoints) < num_ipv4:
+        print(f"Warning: Only {ipv4_space_size} distinct IPv4 endpoints exist. Fewer were generated.")
+
+    endpoints = ipv4_endpoints + ipv6_endpoints
     random.shuffle(endpoints) # Shuffle the final list for more random testing order
     print(f"{len(endpoints)} new unique candidate IP:Port endpoints generated (after shuffle).")
     return endpoints
 
 
-def build_xray_config_json(candidate_endpoints: List[str], warp_params: Dict[str, Any]) -> Dict[str, Any]:
-    """Creates the JSON configuration file for Xray."""
-    inbounds = []
-    outbounds = [{ "protocol": "freedom", "settings": {}, "tag": "direct" }]
-    routing_rules = [{ "type": "field", "outboundTag": "direct", "protocol": ["dns"] }]
-
-    for i, endpoint_addr_port in enumerate(candidate_endpoints):
-        inbound_tag = f"http-in-{i+1}"
-        outbound_tag = f"proxy-{i+1}"
-        local_proxy_port = CORE_INIT_PORT + i
-
-        inbounds.append({
-            "listen": "127.0.0.1", "port": local_proxy_port, "protocol": "http",
-            "tag": inbound_tag, "settings": {"timeout": 120}
-        })
-
-        outbounds.append({
-            "protocol": "wireguard",
-            "settings": {
-                "secretKey": warp_params["PrivateKey"],
-                "address": ["172.16.0.2/32", warp_params["IPv6"]],
-                "peers": [{
-                    "publicKey": warp_params["PublicKey"],
-                    "endpoint": endpoint_addr_port,
-                    "keepAlive": 25
-                }],
-                "mtu": 1280,
-                "reserved": warp_params["Reserved"]
-            },
-            "tag": outbound_tag
-        })
-
-        routing_rules.append({
-            "type": "field", "inboundTag": [inbound_tag], "outboundTag": outbound_tag
-        })
-    
+def build_proxy_tasks(candidate_endpoints: List[str]) -> List[ProxyTask]:
+    """Assigns each candidate its inbound account, outbound tag and proxy credentials once."""
+    return [
+        ProxyTask(endpoint, f"ep-{i}", f"proxy-{i}", aiohttp.BasicAuth(f"ep-{i}", PROXY_ACCOUNT_PASSWORD))
+        for i, endpoint in enumerate(candidate_endpoints, 1)
+    ]
+
+def write_xray_config_json(config_path: str, proxy_tasks: List[ProxyTask], warp_params: Dict[str, Any]) -> None:
+    """Streams the Xray JSON configuration to config_path, one fragment per candidate."""
     # Xray's own access and error log paths (for debugging)
-    xray_log_config_access = os.path.join(CORE_DIR, "access.log") 
-    xray_log_config_error = os.path.join(CORE_DIR, "error.log")   
-
-    return {
-        "log": {"access": xray_log_config_access, "error": xray_log_config_error, "loglevel": "info"}, # Changed loglevel to info
-        "dns": {"servers": ["1.1.1.1", "8.8.8.8", "1.0.0.1"]}, # Added more DNS servers
-        "inbounds": inbounds, "outbounds": outbounds,
-        "routing": {"domainStrategy": "AsIs", "rules": routing_rules}
-    }
+    if DEBUG:
+        xray_log_config = {"access": os.path.join(CORE_DIR, "access.log"), "error": os.path.join(CORE_DIR, "error.log"), "loglevel": "info"}
+    else:
+        xray_log_config = {"access": "none", "loglevel": "warning"}
+
+    # Everything except the endpoint and its tag is identical across outbounds, so serialize it once
+    outbound_head = (
+        '{"protocol":"wireguard","settings":{"secretKey":' + json.dumps(warp_params["PrivateKey"])
+        + ',"address":' + json.dumps(["172.16.0.2/32", warp_params["IPv6"]], separators=(",", ":"))
+        + ',"peers":[{"publicKey":' + json.dumps(warp_params["PublicKey"]) + ',"endpoint":'
+    )
+    outbound_mid = (
+        ',"keepAlive":25}],"mtu":1280,"reserved":' + json.dumps(warp_params["Reserved"], separators=(",", ":"))
+        + '},"tag":"'
+    )
+
+    with open(config_path, "w") as f:
+        f.write('{"log":' + json.dumps(xray_log_config))
+        f.write(',"dns":{"servers":["1.1.1.1","8.8.8.8","1.0.0.1"]}')
+
+        # Each candidate is an account on the shared inbound; the authenticated user picks the outbound
+        f.write(',"inbounds":[{"listen":"127.0.0.1","port":%d,"protocol":"http","tag":"http-in","settings":{"timeout":120,"accounts":[' % CORE_INIT_PORT)
+        f.write(",".join('{"user":"%s","pass":%s}' % (task.account_user, json.dumps(PROXY_ACCOUNT_PASSWORD)) for task in proxy_tasks))
+        f.write(']}}]')
+
+        f.write(',"outbounds":[{"protocol":"freedom","settings":{},"tag":"direct"}')
+        for task in proxy_tasks:
+            f.write("," + outbound_head + json.dumps(task.endpoint) + outbound_mid + task.outbound_tag + '"}')
+        f.write(']')
+
+        f.write(',"routing":{"domainStrategy":"AsIs","rules":[{"type":"field","outboundTag":"direct","protocol":["dns"]}')
+        for task in proxy_tasks:
+            f.write(',{"type":"field","user":["%s"],"outboundTag":"%s"}' % (task.account_user, task.outbound_tag))
+        f.write(']}}')
+
+def wait_for_xray_ready(xray_process: subprocess.Popen, port: int, timeout: float) -> bool:
+    """Polls the local inbound until it accepts a TCP connection; returns False if Xray exits or the timeout passes."""
+    deadline = time.monotonic() + timeout
+    delay = 0.05
+    while time.monotonic() < deadline:
+        if xray_process.poll() is not None:
+            return False
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return True
+        except OSError:
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+    return False
+
+def make_latency_trace_config() -> aiohttp.TraceConfig:
+    """Builds a TraceConfig that stores each request's wire latency in its trace_request_ctx dict."""
+    async def on_request_headers_sent(session: aiohttp.ClientSession, ctx: Any, params: Any) -> None:
+        ctx.sent_at = asyncio.get_running_loop().time()
+
+    async def on_request_end(session: aiohttp.ClientSession, ctx: Any, params: Any) -> None:
+        # Fires once the response headers are parsed, like requests' Response.elapsed
+        ctx.trace_request_ctx["latency_ms"] = (asyncio.get_running_loop().time() - ctx.sent_at) * 1000
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_headers_sent.append(on_request_headers_sent)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+async def probe_proxy_once(session: aiohttp.ClientSession, proxy_address: str, proxy_auth: aiohttp.BasicAuth, target_url: str) -> Optional[float]:
+    """Sends one HEAD request through the proxy and returns its latency in ms, or None on failure."""
+    timing: Dict[str, float] = {}
+    try:
+        async with session.head(
+            target_url,
+            proxy=proxy_address,
+            proxy_auth=proxy_auth,
+            allow_redirects=False,
+            headers={"User-Agent": "Mozilla/5.0"},
+            trace_request_ctx=timing
+        ) as response:
+            if response.status == 204:
+                return timing["latency_ms"]
+    except asyncio.TimeoutError:
+        pass
+    except aiohttp.ClientError:
+        pass
+    return None
+
+async def test_single_proxy(session: aiohttp.ClientSession, original_endpoint: str, proxy_address: str, proxy_auth: aiohttp.BasicAuth, target_url: str, num_tries: int) -> Optional[ScanResult]:
+    """Tests a single proxy and returns its ScanResult, or None if the first try failed."""
+    # A dead endpoint only times out again on retries, so give up after the first failed try
+    first_latency_ms = await probe_proxy_once(session, proxy_address, proxy_auth, target_url)
+    if first_latency_ms is None:
+        return None
 
-def test_single_proxy(original_endpoint: str, proxy_address: str, target_url: str, num_tries: int, timeout: int) -> Optional[ScanResult]:
-    """Tests a single proxy and returns (original_endpoint, avg_latency_ms, loss_rate_percent) or None."""
-    success_count = 0
-    latencies: List[float] = []
+    # The remaining tries run concurrently; a back-off between them buys nothing against a local proxy
+    tries = await asyncio.gather(*(probe_proxy_once(session, proxy_address, proxy_auth, target_url) for _ in range(num_tries - 1)))
+    latencies = [first_latency_ms] + [latency_ms for latency_ms in tries if latency_ms is not None]
 
-    for i in range(num_tries):
-        start_time = time.monotonic()
-        try:
-            response = requests.head(
-                target_url,
-                proxies={"http": proxy_address, "https": proxy_address},
-                timeout=timeout,
-                headers={"User-Agent": "Mozilla/5.0"}
-            )
-            latency_ms = (time.monotonic() - start_time) * 1000
-            if response.status_code == 204:
-                success_count += 1
-                latencies.append(latency_ms)
-        except requests.exceptions.Timeout:
-            pass
-        except requests.exceptions.RequestException:
-            pass
-        if i < num_tries - 1:
-             time.sleep(0.2)
-
-    if not latencies:
+    avg_latency = sum(latencies) / len(latencies)
+    loss_rate = (num_tries - len(latencies)) / num_tries * 100.0
+    # IPv6 endpoints are always written as [addr]:port
+    return ScanResult(original_endpoint, avg_latency, loss_rate, original_endpoint.startswith("["))
+
+async def collect_results(probes: List[Awaitable[Optional[ScanResult]]]) -> List[ScanResult]:
+    """Awaits the probes in completion order, keeps the working results and reports progress every 10."""
+    results: List[ScanResult] = []
+    for tasks_completed, next_result in enumerate(asyncio.as_completed(probes), 1):
+        result = await next_result
+        if result:
+            results.append(result)
+        if tasks_completed % 10 == 0 or tasks_completed == len(probes):
+             print(f"   Test progress: {tasks_completed}/{len(probes)} completed.")
+    return results
+
+async def run_proxy_tests(proxy_tasks: List[ProxyTask], max_concurrent_tests: int) -> List[ScanResult]:
+    """Probes every candidate through the shared Xray inbound on one event loop and collects the working ones."""
+    semaphore = asyncio.Semaphore(max_concurrent_tests)
+    # Room for every try of every in-flight probe, so requests never queue for a pooled connection
+    connector = aiohttp.TCPConnector(limit=max_concurrent_tests * TEST_TRIES, limit_per_host=0)
+    timeout = aiohttp.ClientTimeout(total=TEST_TIMEOUT_SECONDS)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[make_latency_trace_config()]) as session:
+        async def probe(task: ProxyTask) -> Optional[ScanResult]:
+            async with semaphore:
+                try:
+                    return await test_single_proxy(session, task.endpoint, PROXY_URL, task.proxy_auth, TEST_URL, TEST_TRIES)
+                except Exception as exc:
+                    print(f"    Error during test for {task.endpoint}: {exc}")
+                    return None
+
+        return await collect_results([probe(task) for task in proxy_tasks])
+
+
+def wg_hash(data: bytes) -> bytes:
+    return hashlib.blake2s(data).digest()
+
+def wg_kdf(key: bytes, data: bytes, n: int) -> List[bytes]:
+    """HKDF over HMAC-BLAKE2s as used by WireGuard; returns n 32-byte outputs."""
+    prk = hmac.new(key, data, hashlib.blake2s).digest()
+    outputs: List[bytes] = []
+    previous = b""
+    for i in range(1, n + 1):
+        previous = hmac.new(prk, previous + bytes([i]), hashlib.blake2s).digest()
+        outputs.append(previous)
+    return outputs
+
+def wg_aead_encrypt(key: bytes, plaintext: bytes, associated_data: bytes) -> bytes:
+    # Handshake messages always use counter 0
+    return nacl.bindings.crypto_aead_chacha20poly1305_ietf_encrypt(plaintext, associated_data, bytes(12), key)
+
+class WGHandshakeFactory:
+    """Builds handshake initiations for one (our key, peer key) pair.
+
+    Everything that depends only on the two static keys is computed once; each packet
+    then costs one ephemeral key pair, one ephemeral DH, two AEAD seals and the MAC.
+    """
+
+    def __init__(self, static_private_key: bytes, peer_public_key: bytes, reserved: bytes):
+        self.reserved = reserved
+        self.static_public_key = nacl.bindings.crypto_scalarmult_base(static_private_key)
+        self.peer_public_key = peer_public_key
+        self.static_shared_secret = nacl.bindings.crypto_scalarmult(static_private_key, peer_public_key)
+        self.mac1_key = wg_hash(WG_LABEL_MAC1 + peer_public_key)
+        self.initial_chaining_key = wg_hash(WG_CONSTRUCTION)
+        self.initial_hash = wg_hash(wg_hash(self.initial_chaining_key + WG_IDENTIFIER) + peer_public_key)
+        self.last_timestamp_ns = 0
+
+    def tai64n_now(self) -> bytes:
+        """Returns a TAI64N timestamp that is strictly greater than the previous one.
+
+        The peer drops initiations whose timestamp is not newer than the last one it accepted
+        for our static key, so probes sent within the same nanosecond still need distinct values.
+        """
+        self.last_timestamp_ns = max(time.time_ns(), self.last_timestamp_ns + 1)
+        seconds, nanoseconds = divmod(self.last_timestamp_ns, 1_000_000_000)
+        return struct.pack(">QI", 0x400000000000000A + seconds, nanoseconds)
+
+    def build_initiation(self, sender_index: int) -> bytes:
+        """Builds a 148-byte WireGuard handshake initiation message."""
+        ephemeral_private_key = os.urandom(32)
+        ephemeral_public_key = nacl.bindings.crypto_scalarmult_base(ephemeral_private_key)
+        chaining_key, = wg_kdf(self.initial_chaining_key, ephemeral_public_key, 1)
+        handshake_hash = wg_hash(self.initial_hash + ephemeral_public_key)
+
+        chaining_key, key = wg_kdf(chaining_key, nacl.bindings.crypto_scalarmult(ephemeral_private_key, self.peer_public_key), 2)
+        encrypted_static = wg_aead_encrypt(key, self.static_public_key, handshake_hash)
+        handshake_hash = wg_hash(handshake_hash + encrypted_static)
+
+        chaining_key, key = wg_kdf(chaining_key, self.static_shared_secret, 2)
+        encrypted_timestamp = wg_aead_encrypt(key, self.tai64n_now(), handshake_hash)
+
+        message = struct.pack("<B3xI", 1, sender_index) + ephemeral_public_key + encrypted_static + encrypted_timestamp
+        mac1 = hashlib.blake2s(message, digest_size=16, key=self.mac1_key).digest()
+        message = bytearray(message + mac1 + bytes(16)) # mac2 stays zero, we never hold a cookie
+        # WARP expects the client_id in the reserved header bytes; like Xray, set them after the MACs are computed
+        message[1:4] = self.reserved
+        return bytes(message)
+
+class HandshakeReplyProtocol(asyncio.DatagramProtocol):
+    """Resolves a future with the arrival time of the handshake response addressed to sender_index."""
+
+    def __init__(self, sender_index: int):
+        self.sender_index = struct.pack("<I", sender_index)
+        self.loop = asyncio.get_running_loop()
+        self.reply: asyncio.Future = self.loop.create_future()
+
+    def datagram_received(self, data: bytes, addr: Any) -> None:
+        # Handshake response: type 2, our sender index echoed as receiver index at offset 8
+        if len(data) == WG_HANDSHAKE_RESPONSE_SIZE and data[0] == 2 and data[8:12] == self.sender_index and not self.reply.done():
+            self.reply.set_result(self.loop.time())
+
+    def error_received(self, exc: Exception) -> None:
+        if not self.reply.done():
+            self.reply.set_exception(exc)
+
+async def wg_handshake_probe(original_endpoint: str, handshake_factory: WGHandshakeFactory, timeout: float) -> Optional[float]:
+    """Sends one handshake initiation to the endpoint and returns the round-trip time in ms, or None on failure."""
+    host, port = original_endpoint.rsplit(":", 1)
+    sender_index = random.getrandbits(32)
+    loop = asyncio.get_running_loop()
+    transport = None
+    try:
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: HandshakeReplyProtocol(sender_index), remote_addr=(host.strip("[]"), int(port))
+        )
+        packet = handshake_factory.build_initiation(sender_index)
+        sent_at = loop.time()
+        transport.sendto(packet)
+        received_at = await asyncio.wait_for(protocol.reply, timeout)
+        return (received_at - sent_at) * 1000
+    except (asyncio.TimeoutError, OSError):
         return None
-    
+    finally:
+        if transport:
+            transport.close()
+
+async def test_single_endpoint_handshake(original_endpoint: str, handshake_factory: WGHandshakeFactory, num_tries: int, timeout: float) -> Optional[ScanResult]:
+    """Tests a single endpoint with WireGuard handshakes and returns its ScanResult, or None if the first try failed."""
+    latencies: List[float] = []
+    # Tries go out one after another so their timestamps reach the peer in order
+    for i in range(num_tries):
+        latency_ms = await wg_handshake_probe(original_endpoint, handshake_factory, timeout)
+        if latency_ms is not None:
+            latencies.append(latency_ms)
+        elif i == 0:
+            return None # A dead endpoint only times out again on retries
+
+
     avg_latency = sum(latencies) / len(latencies)
-    loss_rate = (num_tries - success_count) / num_tries * 100.0
-    return original_endpoint, avg_latency, loss_rate
+    loss_rate = (num_tries - len(latencies)) / num_tries * 100.0
+    return ScanResult(original_endpoint, avg_latency, loss_rate, original_endpoint.startswith("["))
+
+async def run_handshake_tests(candidate_endpoints: List[str], warp_params: Dict[str, Any], max_concurrent_tests: int) -> List[ScanResult]:
+    """Probes every candidate directly over UDP with WireGuard handshakes and collects the working ones."""
+    semaphore = asyncio.Semaphore(max_concurrent_tests)
+    handshake_factory = WGHandshakeFactory(
+        base64.b64decode(warp_params["PrivateKey"]),
+        base64.b64decode(warp_params["PublicKey"]),
+        bytes(warp_params["Reserved"]),
+    )
+
+    async def probe(original_endpoint: str) -> Optional[ScanResult]:
+        async with semaphore:
+            try:
+                return await test_single_endpoint_handshake(original_endpoint, handshake_factory, TEST_TRIES, TEST_TIMEOUT_SECONDS)
+            except Exception as exc:
+                print(f"    Error during test for {original_endpoint}: {exc}")
+                return None
 
+    return await collect_results([probe(ep) for ep in candidate_endpoints])
 
-def main():
+def run_xray_tests(candidate_endpoints: List[str], warp_params: Dict[str, Any], max_concurrent_tests: int) -> Optional[List[ScanResult]]:
+    """Runs the candidates through Xray and probes each over HTTP; returns None if Xray could not be set up."""
     if not os.path.exists(XRAY_EXECUTABLE_PATH):
         print(f"Error: Xray executable not found at '{XRAY_EXECUTABLE_PATH}'.")
         print("Please download Xray and place it in the correct path or update the XRAY_EXECUTABLE_PATH variable.")
-        return
+        return None
 
     os.makedirs(CORE_DIR, exist_ok=True)
 
-    print("1. Fetching WARP parameters...")
-    warp_params = get_warp_params_for_xray()
-    if not warp_params:
-        print("Failed to fetch WARP parameters. Exiting.")
-        return
-    
-    print(f"Received WARP IPv6 parameter: {warp_params.get('IPv6')}") # Print received IPv6 for checking
-
-    print("\n2. Generating and testing IP endpoints...")
-    all_tested_results: List[ScanResult] = []
-    generated_candidates_set: set[str] = set()
-    
-    initial_candidates_ipv4 = NUM_CANDIDATES_PER_TYPE_TARGET 
-    initial_candidates_ipv6 = NUM_CANDIDATES_PER_TYPE_TARGET
-    
-    print(f"Generating {initial_candidates_ipv4} initial IPv4 and {initial_candidates_ipv6} initial IPv6 candidates...")
-    # Generate IPv4 and IPv6 candidates separately then combine
-    ipv4_candidates = generate_candidate_endpoints(initial_candidates_ipv4, 0, generated_candidates_set)
-    ipv6_candidates = generate_candidate_endpoints(0, initial_candidates_ipv6, generated_candidates_set)
-    candidate_endpoints = ipv4_candidates + ipv6_candidates
-    random.shuffle(candidate_endpoints) # Shuffle final list for better test distribution
-
-    if not candidate_endpoints:
-        print("No candidate endpoints were generated. Exiting.")
-        return
+    proxy_tasks = build_proxy_tasks(candidate_endpoints)
 
-    print(f"\n3. Building Xray configuration for {len(candidate_endpoints)} endpoints...")
-    xray_json_config = build_xray_config_json(candidate_endpoints, warp_params)
+    print(f"\n3. Building Xray configuration for {len(proxy_tasks)} endpoints...")
     try:
-        with open(XRAY_CONFIG_FILE, "w") as f:
-            json.dump(xray_json_config, f, indent=2)
+        write_xray_config_json(XRAY_CONFIG_FILE, proxy_tasks, warp_params)
         print(f"Xray configuration written to {XRAY_CONFIG_FILE}.")
     except IOError as e:
         print(f"Error writing Xray configuration file: {e}")
-        return
+        return None
 
     print("\n4. Starting Xray core...")
     xray_process: Optional[subprocess.Popen] = None
     
     try:
-        # Open log files before starting Xray process
-        with open(XRAY_LOG_STDOUT_FILE, "wb") as stdout_f, open(XRAY_LOG_STDERR_FILE, "wb") as stderr_f:
+        if DEBUG:
+            # Open log files before starting Xray process
+            with open(XRAY_LOG_STDOUT_FILE, "wb") as stdout_f, open(XRAY_LOG_STDERR_FILE, "wb") as stderr_f:
+                xray_process = subprocess.Popen(
+                    [XRAY_EXECUTABLE_PATH, "-c", XRAY_CONFIG_FILE],
+                    stdout=stdout_f, stderr=stderr_f # Redirect stdout and stderr to files
+                )
+        else:
             xray_process = subprocess.Popen(
                 [XRAY_EXECUTABLE_PATH, "-c", XRAY_CONFIG_FILE],
-                stdout=stdout_f, stderr=stderr_f # Redirect stdout and stderr to files
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
             )
         print(f"Xray process started with PID: {xray_process.pid}. Waiting for initialization...")
-        time.sleep(6) # Increased wait time for Xray to initialize
+        ready_start = time.monotonic()
+        if not wait_for_xray_ready(xray_process, CORE_INIT_PORT, XRAY_READY_TIMEOUT_SECONDS):
+            print(f"Error: Xray did not start listening on port {CORE_INIT_PORT} within {XRAY_READY_TIMEOUT_SECONDS}s.")
+            print(f"Check {XRAY_LOG_STDERR_FILE}." if DEBUG else "Re-run with WES_DEBUG=1 to keep Xray logs.")
+            xray_process.kill()
+            xray_process.wait()
+            return None
+        print(f"Xray is ready after {time.monotonic() - ready_start:.2f}s.")
     except FileNotFoundError:
         print(f"Error: Xray executable not found at '{XRAY_EXECUTABLE_PATH}'.")
-        return
+        return None
     except Exception as e:
         print(f"Error starting Xray: {e}")
         if xray_process: xray_process.kill()
-        return
+        return None
 
-    print(f"\n5. Testing {len(candidate_endpoints)} endpoints with max {MAX_CONCURRENT_TESTS} concurrent tests...")
+    print(f"\n5. Testing {len(candidate_endpoints)} endpoints with max {max_concurrent_tests} concurrent tests...")
     
-    tasks_completed = 0
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TESTS) as executor:
-        future_to_endpoint_test = {}
-        for i, original_endpoint_candidate in enumerate(candidate_endpoints):
-            local_proxy_port = CORE_INIT_PORT + i
-            proxy_url_for_test = f"http://127.0.0.1:{local_proxy_port}"
-            future = executor.submit(test_single_proxy, original_endpoint_candidate, proxy_url_for_test, TEST_URL, TEST_TRIES, TEST_TIMEOUT_SECONDS)
-            future_to_endpoint_test[future] = original_endpoint_candidate
-
-        for future in concurrent.futures.as_completed(future_to_endpoint_test):
-            original_endpoint_tested = future_to_endpoint_test[future]
-            try:
-                result: Optional[ScanResult] = future.result()
-                if result:
-                    all_tested_results.append(result)
-            except Exception as exc:
-                print(f"    Error during test for {original_endpoint_tested}: {exc}")
-            tasks_completed +=1
-            # Print progress at reasonable intervals
-            if tasks_completed % (len(candidate_endpoints) // 20 or 1) == 0 or tasks_completed == len(candidate_endpoints):
-                 print(f"   Test progress: {tasks_completed}/{len(candidate_endpoints)} completed.")
-
+    results = asyncio.run(run_proxy_tests(proxy_tasks, max_concurrent_tests))
 
     print("\n6. Stopping Xray core...")
     if xray_process:
@@ -350,41 +530,78 @@ def main():
             xray_process.wait()
             print("Xray process killed.")
 
-    print("\n7. Processing and saving results to README.md...")
+    return results
+
+def main():
+    print("1. Fetching WARP parameters...")
+    warp_params = get_warp_params_for_xray()
+    if not warp_params:
+        print("Failed to fetch WARP parameters. Exiting.")
+        return
+    
+    print(f"Received WARP IPv6 parameter: {warp_params.get('IPv6')}") # Print received IPv6 for checking
+
+    print("\n2. Generating and testing IP endpoints...")
+    all_tested_results: List[ScanResult] = []
+    
+    initial_candidates_ipv4 = NUM_CANDIDATES_PER_TYPE_TARGET 
+    initial_candidates_ipv6 = NUM_CANDIDATES_PER_TYPE_TARGET
     
-    ipv4_results = [r for r in all_tested_results if "." in r[0].split(":", 1)[0] and "[" not in r[0].split(":", 1)[0]]
-    ipv6_results = [r for r in all_tested_results if "[" in r[0].split(":", 1)[0]]
+    print(f"Generating {initial_candidates_ipv4} initial IPv4 and {initial_candidates_ipv6} initial IPv6 candidates...")
+    candidate_endpoints = generate_candidate_endpoints(initial_candidates_ipv4, initial_candidates_ipv6)
 
-    # Sort by latency (ascending, -1 treated as infinity), then by loss rate (ascending)
-    ipv4_results.sort(key=lambda x: (x[1] if x[1] != -1 else float('inf'), x[2]))
-    ipv6_results.sort(key=lambda x: (x[1] if x[1] != -1 else float('inf'), x[2]))
+    if not candidate_endpoints:
+        print("No candidate endpoints were generated. Exiting.")
+        return
+
+    # Probing is pure I/O wait, so give every candidate its own slot up to the cap
+    max_concurrent_tests = min(len(candidate_endpoints), MAX_CONCURRENT_TESTS)
+
+    if PROBE_MODE == "handshake":
+        print(f"\n3. Testing {len(candidate_endpoints)} endpoints with WireGuard handshakes, max {max_concurrent_tests} concurrent tests...")
+        all_tested_results.extend(asyncio.run(run_handshake_tests(candidate_endpoints, warp_params, max_concurrent_tests)))
+    else:
+        xray_results = run_xray_tests(candidate_endpoints, warp_params, max_concurrent_tests)
+        if xray_results is None:
+            return
+        all_tested_results.extend(xray_results)
+
+    print("\nProcessing and saving results to README.md...")
+    
+    ipv4_results: List[ScanResult] = []
+    ipv6_results: List[ScanResult] = []
+    # Probes return None for dead endpoints, so every collected result is a working one
+    for r in all_tested_results:
+        (ipv6_results if r.is_ipv6 else ipv4_results).append(r)
 
     readme_content = ["# Daily WARP Endpoint Test Results"]
     readme_content.append(f"\nLast updated on: {datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}\n")
     
     num_to_output = 10
+    # Best endpoints by latency (ascending), then by loss rate (ascending)
+    sort_key = attrgetter("latency", "loss")
 
     readme_content.append("## Top IPv4 Endpoints")
-    valid_ipv4_results = [r for r in ipv4_results if r[1] != -1][:num_to_output]
+    valid_ipv4_results = heapq.nsmallest(num_to_output, ipv4_results, key=sort_key)
     if valid_ipv4_results:
         if len(valid_ipv4_results) < num_to_output:
             readme_content.append(f"\n*Note: Fewer than {num_to_output} suitable IPv4 endpoints were found (found: {len(valid_ipv4_results)}).*\n")
         readme_content.append("\n| Endpoint | Loss Rate (%) | Avg. Latency (ms) |")
         readme_content.append("|---|---|---|")
         for res in valid_ipv4_results:
-            readme_content.append(f"| `{res[0]}` | {res[2]:.2f} | {res[1]:.2f} |")
+            readme_content.append(f"| `{res.endpoint}` | {res.loss:.2f} | {res.latency:.2f} |")
     else:
         readme_content.append("\n*No suitable IPv4 endpoints were found.*\n")
 
     readme_content.append("\n## Top IPv6 Endpoints")
-    valid_ipv6_results = [r for r in ipv6_results if r[1] != -1][:num_to_output]
+    valid_ipv6_results = heapq.nsmallest(num_to_output, ipv6_results, key=sort_key)
     if valid_ipv6_results:
         if len(valid_ipv6_results) < num_to_output:
             readme_content.append(f"\n*Note: Fewer than {num_to_output} suitable IPv6 endpoints were found (found: {len(valid_ipv6_results)}).*\n")
         readme_content.append("\n| Endpoint | Loss Rate (%) | Avg. Latency (ms) |")
         readme_content.append("|---|---|---|")
         for res in valid_ipv6_results:
-            readme_content.append(f"| `{res[0]}` | {res[2]:.2f} | {res[1]:.2f} |")
+            readme_content.append(f"| `{res.endpoint}` | {res.loss:.2f} | {res.latency:.2f} |")
     else:
         readme_content.append("\n*No suitable IPv6 endpoints were found.*\n")
 
@@ -394,8 +611,8 @@ def main():
             for line in readme_content:
                 f.write(line + "\n")
         print(f"\nResults successfully written to {output_filename_md}.")
-        print(f"Total working IPv4 endpoints found (before final filter): {len([r for r in ipv4_results if r[1]!=-1])}")
-        print(f"Total working IPv6 endpoints found (before final filter): {len([r for r in ipv6_results if r[1]!=-1])}")
+        print(f"Total working IPv4 endpoints found: {len(ipv4_results)}")
+        print(f"Total working IPv6 endpoints found: {len(ipv6_results)}")
 
     except IOError as e:
         print(f"Error writing README.md file: {e}")